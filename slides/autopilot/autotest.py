@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import atexit
 import click
+import codecs
 import logging
+import math
 import os
 import random
 import re
 import select
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
 import time
 import uuid
 import yaml
@@ -16,16 +23,65 @@ import yaml
 
 logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 
+# Use the libyaml bindings when they are available
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
 
 TIMEOUT = 60 # 1 minute
 
+# When waiting for something to show up in the pane, we check again
+# quickly at first (most prompts show up within a few tens of ms),
+# then less and less often.
+POLL_DELAY_MIN = 0.02
+POLL_DELAY_MAX = 0.5
+
+# Regexes used to parse the slides and the pane output.
+# (Compiled once here, rather than looked up in the re cache at each call.)
+EXCLUDED_CLASSES_RE = re.compile(r"excludedClasses: (\[.*\])")
+LEADING_SPACES_RE = re.compile(r"\n +")
+IPADDR_RE = re.compile(r"^\[(.*)\]", re.MULTILINE)
+CLASSES_RE = re.compile(r"class: (.*)")
+
+# Everything we need to find in the markdown source, so that we can go
+# through it in a single pass: slide separators, speaker notes (remark.js
+# uses ??? as the separator for speaker notes), and exercises. (Slide
+# classes are not in there: they can show up anywhere in a slide, e.g.
+# right after the <textarea> tag on the first slide.)
+# An exercise goes from .exercise[ to the last ] of the slide (some
+# slides rely on that to run commands shown after the exercise), but it
+# stops at the end of the slide or at the speaker notes.
+# All these start on a new line; having that common "\n" prefix lets the
+# regex engine skip quickly to the next candidate.
+# When looking for the closing ], the regex engine backtracks at most to
+# the beginning of the exercise, so this stays linear even when brackets
+# don't line up. (That's why we stick to the re module: re2 doesn't
+# support lookaheads, and the regex module is slower on this pattern.)
+DECK_RE = re.compile(
+    r"\n(?:(?P<separator>---?(?=\n))"
+    r"|(?P<notes>\?\?\?(?=\n))"
+    r"|\.exercise\[(?P<exercise>[^\n]*(?:\n(?!---?\n|\?\?\?\n)[^\n]*)*)\])")
+
+# Escape sequences (colors, cursor movements, window titles...) that we
+# strip from the pane output before looking at it.
+ANSI_ESCAPE_RE = re.compile(
+    rb"\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[()][0-9A-Za-z]|[78=>@-Z\\^_])")
+
 # This one is not a constant. It's an ugly global.
 IPADDR = None
 
+# Last workspace shown with focus_*(), so that we only switch when needed.
+FOCUS = None
+
+# Terminal width: looked up on first use, and again when the terminal is resized.
+COLS = None
+
 
 class State(object):
 
     def __init__(self):
+        # Set whenever a field changes, so that we only save when needed
+        self.dirty = True
         self.interactive = True
         self.verify_status = False
         self.simulate_type = True
@@ -33,14 +89,23 @@ class State(object):
         self.snippet = 0
 
     def load(self):
-        data = yaml.load(open("state.yaml"))
+        with open("state.yaml") as f:
+            data = yaml.load(f, Loader=SafeLoader)
         self.interactive = bool(data["interactive"])
         self.verify_status = bool(data["verify_status"])
         self.simulate_type = bool(data["simulate_type"])
         self.slide = int(data["slide"])
         self.snippet = int(data["snippet"])
+        self.dirty = False
+
+    def __setattr__(self, name, value):
+        if name != "dirty" and getattr(self, name, None) != value:
+            object.__setattr__(self, "dirty", True)
+        object.__setattr__(self, name, value)
 
     def save(self):
+        if not self.dirty:
+            return
         with open("state.yaml", "w") as f:
             yaml.dump(dict(
                 interactive=self.interactive,
@@ -48,14 +113,24 @@ class State(object):
                 simulate_type=self.simulate_type,
                 slide=self.slide,
                 snippet=self.snippet,
-                ), f, default_flow_style=False)
+                ), f, Dumper=SafeDumper, default_flow_style=False)
+        self.dirty = False
 
 
 state = State()
 
 
+def refresh_cols(*args):
+    global COLS
+    COLS = shutil.get_terminal_size((80, 20)).columns
+
+signal.signal(signal.SIGWINCH, refresh_cols)
+
+
 def hrule():
-    return "="*int(subprocess.check_output(["tput", "cols"]))
+    if COLS is None:
+        refresh_cols()
+    return "="*COLS
 
 # A "snippet" is something that the user is supposed to do in the workshop.
 # Most of the "snippets" are shell commands.
@@ -76,6 +151,14 @@ class Snippet(object):
         else:
             self.method, self.data = content.split(' ', 1)
         self.data = self.data.strip()
+        # For bash snippets, what we actually type:
+        # strip leading spaces, remove backticks (they are used to
+        # highlight sections), and add "RETURN" at the end :)
+        self.command = LEADING_SPACES_RE.sub("\n", self.data).replace('`', '') + "\n"
+        # Where the snippet is in the slide content, and the slide with
+        # the snippet highlighted (both set by the Slide)
+        self.span = None
+        self.highlighted_slide = None
         self.next = None
 
     def __str__(self):
@@ -86,22 +169,25 @@ class Slide(object):
 
     current_slide = 0
 
-    def __init__(self, content):
+    # The exercises are (offset in content, exercise text) tuples
+    def __init__(self, content, exercises=()):
         self.number = Slide.current_slide
         Slide.current_slide += 1
-
-        # Remove commented-out slides
-        # (remark.js considers ??? to be the separator for speaker notes)
-        content = re.split("\n\?\?\?\n", content)[0]
         self.content = content
 
         self.snippets = []
-        exercises = re.findall("\.exercise\[(.*)\]", content, re.DOTALL)
-        for exercise in exercises:
+        for offset, exercise in exercises:
             if "```" in exercise:
                 previous = None
-                for snippet_content in exercise.split("```")[1::2]:
+                parts = exercise.split("```")
+                for i in range(1, len(parts), 2):
+                    snippet_content = parts[i]
                     snippet = Snippet(self, snippet_content)
+                    # Skip what's before the snippet, and the ``` around it
+                    offset += len(parts[i-1]) + 3
+                    snippet.span = (offset, offset+len(snippet_content))
+                    offset += len(snippet_content) + 3
+                    snippet.highlighted_slide = self.highlighted([snippet])
                     if previous:
                         previous.next = snippet
                     previous = snippet
@@ -112,31 +198,47 @@ class Slide(object):
                 self.debug()
 
     def __str__(self):
-        text = self.content
-        for snippet in self.snippets:
-            text = text.replace(snippet.content, ansi("7")(snippet.content))
-        return text
+        return self.highlighted(self.snippets)
+
+    # Returns the content of the slide, with the given snippets highlighted
+    def highlighted(self, snippets):
+        text, end = [], 0
+        for snippet in snippets:
+            start = snippet.span[0]
+            text.append(self.content[end:start])
+            end = snippet.span[1]
+            text.append(highlight(self.content[start:end]))
+        text.append(self.content[end:])
+        return "".join(text)
 
     def debug(self):
         logging.debug("\n{}\n{}\n{}".format(hrule(), self.content, hrule()))
 
 
+def focus(workspace):
+    global FOCUS
+    # Don't switch again if that's already what we're showing
+    if FOCUS == workspace:
+        return
+    subprocess.check_output(["i3-msg", "workspace {}; workspace 1".format(workspace)])
+    FOCUS = workspace
+
 def focus_slides():
-    subprocess.check_output(["i3-msg", "workspace", "3"])
-    subprocess.check_output(["i3-msg", "workspace", "1"])
+    focus(3)
 
 def focus_terminal():
-    subprocess.check_output(["i3-msg", "workspace", "2"])
-    subprocess.check_output(["i3-msg", "workspace", "1"])
+    focus(2)
 
 def focus_browser():
-    subprocess.check_output(["i3-msg", "workspace", "4"])
-    subprocess.check_output(["i3-msg", "workspace", "1"])
+    focus(4)
 
 
 def ansi(code):
     return lambda s: "\x1b[{}m{}\x1b[0m".format(code, s)
 
+# Reverse video, to highlight snippets in their slide
+highlight = ansi("7")
+
 
 # Sleeps the indicated delay, but interruptible by pressing ENTER.
 # If interrupted, returns True.
@@ -145,30 +247,205 @@ def interruptible_sleep(t):
     return 0 in rfds
 
 
+# Instead of running a new tmux client for each tmux command, we keep a
+# single client in control mode ("tmux -C"). We write commands on its
+# stdin, one per line; their output comes back on its stdout, between
+# %begin and %end (or %error) lines.
+
+class TmuxError(Exception):
+    pass
+
+
+class TmuxClient(object):
+
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(["tmux", "-C", "attach"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # We don't need a notification for every byte output in the pane.
+        # (Older versions of tmux don't have that flag; then we'll just
+        # skip these notifications when reading.)
+        try:
+            self.command("refresh-client", "-f", "no-output")
+        except TmuxError:
+            pass
+
+    def command(self, *args):
+        line = " ".join(shlex.quote(arg) for arg in args)
+        self.process.stdin.write(line.encode("utf-8") + b"\n")
+        self.process.stdin.flush()
+        return self.read_output(args)
+
+    def read_output(self, args):
+        # Skip notifications until the beginning of the next block for one
+        # of our commands. (The flags of these blocks are set to 1; tmux
+        # also sends a block with flags 0 for the attach command itself,
+        # and not necessarily before the output of our first command.)
+        line = self.readline()
+        while not (line.startswith("%begin ") and line.endswith(" 1")):
+            line = self.readline()
+        stamp = line[len("%begin "):]
+        output = []
+        while True:
+            line = self.readline()
+            if line == "%end " + stamp:
+                return "".join(line + "\n" for line in output)
+            if line == "%error " + stamp:
+                raise TmuxError("tmux {} failed: {}".format(" ".join(args), "\n".join(output)))
+            output.append(line)
+
+    def readline(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise TmuxError("Lost connection to tmux.")
+        return line.decode("utf-8", "replace").rstrip("\n")
+
+
+tmux = TmuxClient()
+
+
+# Rather than polling the pane with "tmux capture-pane", we ask tmux to
+# copy everything that gets output in the pane to a temporary file, and we
+# read that file as it grows. If the tmux server is not on this machine
+# (e.g. when controlling a remote tmux through its socket), our file never
+# gets written, and we fall back to polling.
+
+class PaneStream(object):
+
+    def __init__(self):
+        self.file = None
+        self.path = None
+        # Incomplete escape sequence at the end of the last read
+        self.pending = b""
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        # The last few KB of output (after stripping escape sequences)
+        self.tail = ""
+
+    def start(self):
+        # The pipe command starts by writing a token, so that we can
+        # tell whether its output ends up in our file or not.
+        token = uuid.uuid4().hex
+        marker = "{}\n".format(token).encode("ascii")
+        # mkstemp creates a new file that only we can access (rather than
+        # following whatever another user might have left in /tmp)
+        fd, self.path = tempfile.mkstemp(prefix="autotest-", suffix=".pane")
+        f = os.fdopen(fd, "rb", buffering=0)
+        atexit.register(self.stop)
+        tmux.command("pipe-pane", "{{ echo {}; exec cat; }} >> {}"
+                     .format(token, shlex.quote(self.path)))
+        data = b""
+        deadline = time.time() + 2
+        while marker not in data:
+            if time.time() > deadline:
+                logging.warning("Could not stream pane output to {}; polling instead."
+                                .format(self.path))
+                f.close()
+                self.stop()
+                return
+            data += f.read(65536) or b""
+            time.sleep(0.05)
+        self.file = f
+        self.pending = data.split(marker, 1)[1]
+        # Start with what's already on the screen (e.g. the current prompt)
+        self.tail = capture_pane()
+
+    # Closes the pipe (otherwise, it would keep appending to the file after
+    # we're gone), and removes the file.
+    def stop(self):
+        if not self.path:
+            return
+        try:
+            tmux.command("pipe-pane")
+        except (TmuxError, OSError):
+            # tmux is already gone (and the pipe with it)
+            pass
+        if self.file:
+            self.file.close()
+            self.file = None
+        os.remove(self.path)
+        self.path = None
+
+    # Returns what was output in the pane since the last call.
+    def read(self):
+        chunks = []
+        while True:
+            chunk = self.file.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        # Most of the time, nothing new was written; nothing to do then
+        if not chunks:
+            return ""
+        data = self.pending + b"".join(chunks)
+        # Keep the beginning of an escape sequence for the next round,
+        # in case the rest of the sequence hasn't been written yet.
+        cut = data.rfind(b"\x1b")
+        if cut != -1 and len(data)-cut < 32 and not ANSI_ESCAPE_RE.match(data, cut):
+            data, self.pending = data[:cut], data[cut:]
+        else:
+            self.pending = b""
+        text = self.decoder.decode(ANSI_ESCAPE_RE.sub(b"", data).replace(b"\r", b""))
+        self.tail = (self.tail + text)[-4096:]
+        return text
+
+
+pane_stream = PaneStream()
+
+
 def wait_for_string(s, timeout=TIMEOUT):
     logging.debug("Waiting for string: {}".format(s))
     deadline = time.time() + timeout
+    delay = POLL_DELAY_MIN
+    # With streaming, we only look at new output (plus the end of the
+    # previous output, in case s was split between two reads).
+    overlap = pane_stream.tail
     while time.time() < deadline:
-        output = capture_pane()
+        if pane_stream.file:
+            output = overlap + pane_stream.read()
+            overlap = output[-len(s):]
+        else:
+            output = capture_pane()
         if s in output:
             return
-        if interruptible_sleep(1): return
+        if interruptible_sleep(delay): return
+        delay = min(delay*1.5, POLL_DELAY_MAX)
     raise Exception("Timed out while waiting for {}!".format(s))
 
 
 def wait_for_prompt():
     logging.debug("Waiting for prompt.")
     deadline = time.time() + TIMEOUT
+    delay = POLL_DELAY_MIN
     while time.time() < deadline:
-        output = capture_pane()
+        if pane_stream.file:
+            pane_stream.read()
+            output = pane_stream.tail
+        else:
+            output = capture_pane()
         # If we are not at the bottom of the screen, there will be a bunch of extra \n's
         output = output.rstrip('\n')
-        last_line = output.split('\n')[-1]
+        # Only look at the last line, without splitting the whole output
+        # (The streamed output also has the space following the prompt)
+        last_line = output[output.rfind('\n')+1:].rstrip()
         # Our custom prompt on the VMs has two lines; the 2nd line is just '$'
         if last_line == "$":
-            # This is a perfect opportunity to grab the node's IP address
+            # This is a perfect opportunity to grab the node's IP address.
+            # When streaming, look at the screen rather than at the output:
+            # after a full screen program or output without a final newline,
+            # the output doesn't have the prompt's first line on its own.
             global IPADDR
-            IPADDR = re.findall("^\[(.*)\]", output, re.MULTILINE)[-1]
+            screen = capture_pane() if pane_stream.file else output
+            # (Like the old findall, use the most recent match)
+            match = None
+            for match in IPADDR_RE.finditer(screen):
+                pass
+            if match:
+                IPADDR = match.group(1)
+            else:
+                logging.warning("Could not find the IP address on the screen; "
+                                "keeping {}.".format(IPADDR))
             return
         # When we are in an alpine container, the prompt will be "/ #"
         if last_line == "/ #":
@@ -176,27 +453,61 @@ def wait_for_prompt():
         # We did not recognize a known prompt; wait a bit and check again
         logging.debug("Could not find a known prompt on last line: {!r}"
                       .format(last_line))
-        if interruptible_sleep(1): return
+        if interruptible_sleep(delay): return
+        delay = min(delay*1.5, POLL_DELAY_MAX)
     raise Exception("Timed out while waiting for prompt!")
 
 
-def check_exit_status():
-    if not state.verify_status:
-        return
+# Appends "; printf '\n<token> %d\n' $?" to a (single line) bash command,
+# so that it prints its own exit status, and we don't have to send another
+# command to get it. (The status goes on a line of its own, even if the
+# command's output doesn't end with a newline.) Returns the new command
+# and the token; or the command unchanged and None, if it doesn't look
+# safe to append to it.
+def add_exit_status(command):
+    line = command.rstrip("\n")
+    if "\n" in line or "#" in line or line.rstrip().endswith(("&", ";", "|", "\\")):
+        return command, None
     token = uuid.uuid4().hex
-    data = "echo {} $?\n".format(token)
-    logging.debug("Sending {!r} to get exit status.".format(data))
-    send_keys(data)
-    time.sleep(0.5)
-    wait_for_prompt()
+    return "{}; printf '\\n{} %d\\n' $?\n".format(line, token), token
+
+
+def find_exit_status(token):
     screen = capture_pane()
-    status = re.findall("\n{} ([0-9]+)\n".format(token), screen, re.MULTILINE)
+    # (The command line itself has the token too, but not followed by digits)
+    status_re = re.compile(r"{} ([0-9]+)$".format(token), re.MULTILINE)
+    status = None
+    for match in status_re.finditer(screen):
+        if status is not None:
+            raise Exception("More than one status code {}. I'm seeing double! Shoot them both.".format(token))
+        status = match.group(1)
+    return status
+
+
+# If the command was sent through add_exit_status(), pass its token.
+def check_exit_status(token=None):
+    if not state.verify_status:
+        return
+    status = None
+    if token:
+        status = find_exit_status(token)
+        if status is None:
+            # The command didn't get to print it: e.g. it started another
+            # shell (docker run -ti...) and we're now at its prompt; ask
+            # that shell instead.
+            logging.debug("Status code {} not found after the command.".format(token))
+    if status is None:
+        token = uuid.uuid4().hex
+        data = "echo {} $?\n".format(token)
+        logging.debug("Sending {!r} to get exit status.".format(data))
+        send_keys(data)
+        time.sleep(0.5)
+        wait_for_prompt()
+        status = find_exit_status(token)
     logging.debug("Got exit status: {}.".format(status))
-    if len(status) == 0:
+    if status is None:
         raise Exception("Couldn't retrieve status code {}. Timed out?".format(token))
-    if len(status) > 1:
-        raise Exception("More than one status code {}. I'm seeing double! Shoot them both.".format(token))
-    code = int(status[0])
+    code = int(status)
     if code != 0:
         raise Exception("Non-zero exit status: {}.".format(code))
     # Otherwise just return peacefully.
@@ -223,6 +534,8 @@ tmux new-session ssh docker@{ipaddr}
 """.format(uid=uid, ipaddr=ipaddr))
     else:
         logging.info("Found tmux session. Trying to acquire shell prompt.")
+        tmux.start()
+        pane_stream.start()
         wait_for_prompt()
     logging.info("Successfully connected to test cluster in tmux session.")
 
@@ -232,37 +545,81 @@ content = open(sys.argv[1]).read()
 
 # OK, this part is definitely hackish, and will break if the
 # excludedClasses parameter is not on a single line.
-excluded_classes = re.findall("excludedClasses: (\[.*\])", content)
-excluded_classes = set(eval(excluded_classes[0]))
-
-for slide in re.split("\n---?\n", content):
-    slide_classes = re.findall("class: (.*)", slide)
-    if slide_classes:
-        slide_classes = slide_classes[0].split(",")
-        slide_classes = [c.strip() for c in slide_classes]
-    if excluded_classes & set(slide_classes):
+# (We only need the first occurrence, so don't scan the whole deck for more.)
+excluded_classes = EXCLUDED_CLASSES_RE.search(content).group(1)
+excluded_classes = set(eval(excluded_classes))
+
+
+# Yields (content, classes, exercises) for each slide.
+# The content doesn't include the speaker notes; and neither do the exercises.
+# The classes are the first "class:" found anywhere between the separators.
+def split_slides(content):
+    start, notes, exercises = 0, None, []
+    for match in DECK_RE.finditer(content):
+        kind = match.lastgroup
+        if kind == "separator":
+            yield slide_parts(content, start, match.start(), notes, exercises)
+            # (The next slide starts after the \n that ends the separator)
+            start, notes, exercises = match.end()+1, None, []
+        elif kind == "notes":
+            if notes is None:
+                notes = match.start()
+        elif notes is None:
+            exercises.append((match.start("exercise")-start, match.group("exercise")))
+    yield slide_parts(content, start, len(content), notes, exercises)
+
+
+def slide_parts(content, start, end, notes, exercises):
+    classes = CLASSES_RE.search(content, start, end)
+    if classes:
+        classes = classes.group(1)
+    return content[start:end if notes is None else notes], classes, exercises
+
+
+for slide, slide_classes, exercises in split_slides(content):
+    # Most slides don't have any class; and we can stop at the first excluded one
+    if slide_classes and any(c.strip() in excluded_classes
+                             for c in slide_classes.split(",")):
         logging.info("Skipping excluded slide.")
         continue
-    slides.append(Slide(slide))
+    slides.append(Slide(slide, exercises))
+
+
+# How long it would take to type some text, pausing 0 to 150ms after
+# each key. That's a sum of uniform random delays; for a whole line, a
+# normal distribution with the same mean and variance is close enough,
+# and saves us from drawing one random number per key.
+def typing_delay(text):
+    n = len(text)
+    return max(0, random.gauss(0.075*n, 0.15*math.sqrt(n/12.0)))
 
 
 def send_keys(data):
-    if state.simulate_type and data[0] != '^':
-        for key in data:
-            if key == ";":
-                key = "\\;"
-            if key == "\n":
-                if interruptible_sleep(1): return
-            subprocess.check_call(["tmux", "send-keys", key])
-            if interruptible_sleep(0.15*random.random()): return
-            if key == "\n":
-                if interruptible_sleep(1): return
-    else:
-        subprocess.check_call(["tmux", "send-keys", data])
+    # Keys like ^C are sent as is; tmux knows what they mean
+    if data[0] == '^':
+        tmux.command("send-keys", data)
+        return
+    simulate = state.simulate_type
+    # Send each line with a single tmux command (in literal mode, so that
+    # tmux doesn't try to interpret key names; "--" stops it from taking
+    # lines like "--mount ..." for flags). When simulating typing,
+    # pause as long as it would have taken to type it. The longer pauses
+    # around line breaks are kept, because that's where the delay actually
+    # matters. (Line breaks are sent separately anyway, because a tmux
+    # command cannot span multiple lines in control mode.)
+    lines = data.split("\n")
+    for i, line in enumerate(lines):
+        if line:
+            tmux.command("send-keys", "-l", "--", line)
+            if simulate and interruptible_sleep(typing_delay(line)): return
+        if i < len(lines)-1:
+            if simulate and interruptible_sleep(1): return
+            tmux.command("send-keys", "Enter")
+            if simulate and interruptible_sleep(1): return
 
 
 def capture_pane():
-    return subprocess.check_output(["tmux", "capture-pane", "-p"]).decode('utf-8')
+    return tmux.command("capture-pane", "-p")
 
 
 setup_tmux_and_ssh()
@@ -313,7 +670,7 @@ while True:
                   state.simulate_type, state.verify_status))
     print(hrule())
     if snippet:
-        print(slide.content.replace(snippet.content, ansi(7)(snippet.content)))
+        print(snippet.highlighted_slide)
         focus_terminal()
     else:
         print(slide.content)
@@ -369,31 +726,31 @@ while True:
         elif method == "bash":
             # Make sure that we're ready
             wait_for_prompt()
-            # Strip leading spaces
-            data = re.sub("\n +", "\n", data)
-            # Remove backticks (they are used to highlight sections)
-            data = data.replace('`', '')
-            # Add "RETURN" at the end of the command :)
-            data += "\n"
+            cmd, token = snippet.command, None
+            waiting = snippet.next and snippet.next.method in ("wait", "longwait")
+            if state.verify_status and not waiting:
+                cmd, token = add_exit_status(cmd)
             # Send command
-            send_keys(data)
+            send_keys(cmd)
             # Force a short sleep to avoid race condition
             time.sleep(0.5)
-            if snippet.next and snippet.next.method == "wait":
-                wait_for_string(snippet.next.data)
-            elif snippet.next and snippet.next.method == "longwait":
-                wait_for_string(snippet.next.data, 10*TIMEOUT)
+            if waiting:
+                longwait = snippet.next.method == "longwait"
+                wait_for_string(snippet.next.data, 10*TIMEOUT if longwait else TIMEOUT)
             else:
                 wait_for_prompt()
                 # Verify return code
-                check_exit_status()
+                check_exit_status(token)
         elif method == "copypaste":
             screen = capture_pane()
-            matches = re.findall(data, screen, flags=re.DOTALL)
-            if len(matches) == 0:
-                raise Exception("Could not find regex {} in output.".format(data))
             # Arbitrarily get the most recent match
-            match = matches[-1]
+            match = None
+            for match in re.finditer(data, screen, flags=re.DOTALL):
+                pass
+            if match is None:
+                raise Exception("Could not find regex {} in output.".format(data))
+            # (Like findall, use the group if the regex has one)
+            match = match.group(1 if match.re.groups else 0)
             # Remove line breaks (like a screen copy paste would do)
             match = match.replace('\n', '')
             send_keys(match + '\n')
@@ -401,8 +758,7 @@ while True:
             wait_for_prompt()
             check_exit_status()
         elif method == "open":
-            # Cheap way to get node1's IP address
-            screen = capture_pane()
+            # node1's IP address was grabbed from the last prompt
             url = data.replace("/node1", "/{}".format(IPADDR))
             # This should probably be adapted to run on different OS
             subprocess.check_output(["xdg-open", url])